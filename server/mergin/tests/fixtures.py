@@ -2,14 +2,19 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
+import hashlib
 import os
 import sys
+import tempfile
 import uuid
 from copy import deepcopy
-from shutil import copy, move
+from datetime import datetime, timedelta
+from shutil import copy, copytree, move, rmtree
 from flask import current_app
 from flask_login import current_user
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex, CreateTable
 from pygeodiff import GeoDiff
 import pytest
 
@@ -19,15 +24,122 @@ from ..sync.utils import generate_checksum, is_versioned_file, resolve_tags
 from ..stats.app import register
 from ..stats.models import MerginInfo
 from . import test_project, test_workspace_id, test_project_dir, TMP_DIR
-from .utils import login_as_admin, initialize, cleanup, file_info, create_project
+from .utils import (
+    login_as_admin,
+    initialize,
+    init_test_project_files,
+    cleanup,
+    file_info,
+    create_project,
+)
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(thisdir, os.pardir))
 
 
-@pytest.fixture(scope="function")
+def _truncate_all():
+    """Remove all data from db tables and reset their identity sequences"""
+    tables = ", ".join(f'"{t.name}"' for t in reversed(db.metadata.sorted_tables))
+    db.session.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+    db.session.commit()
+
+
+def _schema_signature():
+    """Hash of DDL for all db tables, it changes whenever models are modified"""
+    ddl = []
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(db.engine)))
+        ddl.extend(str(CreateIndex(idx).compile(db.engine)) for idx in table.indexes)
+    return hashlib.md5(repr(sorted(ddl)).encode()).hexdigest()
+
+
+def _init_schema():
+    """Reuse db schema from previous test session if models did not change, otherwise recreate it"""
+    sig = _schema_signature()
+    db.session.execute(text("CREATE TABLE IF NOT EXISTS schema_meta (sig TEXT)"))
+    stored_sig = db.session.execute(text("SELECT sig FROM schema_meta")).scalar()
+    db.session.commit()
+    # tables might have been dropped since signature was stored (e.g. by db downgrade)
+    existing_tables = set(inspect(db.engine).get_table_names())
+    if stored_sig == sig and existing_tables.issuperset(
+        t.name for t in db.metadata.sorted_tables
+    ):
+        # in case of leftovers from previous session
+        _truncate_all()
+        return
+
+    try:
+        db.drop_all()
+    except SQLAlchemyError:
+        # leftover objects outside of models (e.g. foreign keys) block plain drop
+        db.session.rollback()
+        tables = ", ".join(f'"{t.name}"' for t in db.metadata.sorted_tables)
+        db.session.execute(text(f"DROP TABLE IF EXISTS {tables} CASCADE"))
+        db.session.commit()
+        # remaining non-table objects, e.g. enum types
+        db.drop_all()
+    db.create_all()
+    db.session.execute(text("DELETE FROM schema_meta"))
+    db.session.execute(
+        text("INSERT INTO schema_meta (sig) VALUES (:sig)"), {"sig": sig}
+    )
+    db.session.commit()
+
+
+def _stage(src, dst):
+    """Hardlink file which is not going to be modified, fall back to copy (e.g. across filesystems)"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy(src, dst)
+
+
+def _begin_rollback_transaction(**session_options):
+    """Bind db session to new connection with open transaction and SAVEPOINT.
+    Session commits only release SAVEPOINT which is started again right away.
+
+    :param session_options: extra session options valid until rollback, e.g. autoflush
+    :returns: function to roll back all changes done in db
+    """
+    db.session.remove()
+    default_options = {
+        key: db.session.session_factory.kw[key] for key in session_options
+    }
+    connection = db.engine.connect()
+    # sequences are not transactional, remember their values to be restored
+    sequences = connection.execute(
+        text("SELECT sequencename, last_value FROM pg_sequences")
+    ).fetchall()
+    transaction = connection.begin()
+    nested = connection.begin_nested()
+    # flask-sqlalchemy maps all tables to engine by default, bind them to our connection instead
+    db.session.configure(bind=connection, binds={}, **session_options)
+
+    def restart_savepoint(session, trans):
+        nonlocal nested
+        if not nested.is_active:
+            nested = connection.begin_nested()
+
+    event.listen(db.session, "after_transaction_end", restart_savepoint)
+
+    def rollback():
+        event.remove(db.session, "after_transaction_end", restart_savepoint)
+        db.session.remove()
+        db.session.configure(bind=None, binds=db.get_binds(), **default_options)
+        transaction.rollback()
+        for name, value in sequences:
+            connection.execute(
+                text("SELECT setval(:name, :value, :is_called)"),
+                {"name": name, "value": value or 1, "is_called": value is not None},
+            )
+        connection.close()
+
+    return rollback
+
+
+@pytest.fixture(scope="session")
 def flask_app(request):
-    """Flask app with fresh db and initialized empty tables"""
+    """Flask app with db schema and testing objects created once for the whole test session"""
     from ..sync.db_events import remove_events
 
     application = create_app(
@@ -43,16 +155,25 @@ def flask_app(request):
     application.config["SERVER_NAME"] = "localhost.localdomain"
     application.config["SERVER_TYPE"] = "ce"
     application.config["SERVICE_ID"] = str(uuid.uuid4())
+    # test db is disposable, do not wait for WAL flush on every commit
+    application.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **application.config["SQLALCHEMY_ENGINE_OPTIONS"],
+        "connect_args": {"options": "-c synchronous_commit=off"},
+    }
     app_context = application.app_context()
     app_context.push()
 
     with app_context:
-        db.create_all()
+        _init_schema()
+        initialize()
+        info = MerginInfo(service_id=current_app.config["SERVICE_ID"])
+        db.session.add(info)
+        db.session.commit()
 
     def teardown():
-        # clean up db
+        # clean up db, schema is kept to be reused by next session
+        _truncate_all()
         db.session.remove()
-        db.drop_all()
         db.engine.dispose()
 
         app_context.pop()
@@ -64,21 +185,40 @@ def flask_app(request):
 
 
 @pytest.fixture(scope="function")
-def app(flask_app, request):
+def db_session(flask_app, request):
+    """Wrap test in db transaction which is rolled back at the end, hence testing objects
+    created in flask_app are preserved
+    """
+    config = flask_app.config.copy()
+    # fresh app context per test so nothing is shared via flask.g
+    app_context = flask_app.app_context()
+    app_context.push()
+    rollback = _begin_rollback_transaction()
+
+    def teardown():
+        rollback()
+        app_context.pop()
+        # revert config changes done by test
+        flask_app.config.clear()
+        flask_app.config.update(config)
+
+    request.addfinalizer(teardown)
+    return db.session
+
+
+@pytest.fixture(scope="function")
+def app(flask_app, db_session, request):
     """Flask app with testing objects created"""
-    with flask_app.app_context():
-        initialize()
-        info = MerginInfo(service_id=current_app.config["SERVICE_ID"])
-        db.session.add(info)
-        db.session.commit()
+    init_test_project_files()
 
     def teardown():
-        # remove all project files
+        # remove all project files, paths are taken directly from storage params
+        # as setting up project storage (incl. geodiff) for each project is expensive
         with flask_app.app_context():
             dirs = [
-                p.storage.project_dir
-                for p in Project.query.all()
-                if p.storage is not None
+                params["location"]
+                for (params,) in db.session.query(Project.storage_params)
+                if params
             ]
             cleanup(flask_app.test_client(), dirs)
 
@@ -86,19 +226,38 @@ def app(flask_app, request):
     return flask_app
 
 
+@pytest.fixture(scope="session")
+def admin_cookie(flask_app):
+    """Session cookie of logged-in superuser, so password is verified only once per session"""
+    with flask_app.app_context():
+        rollback = _begin_rollback_transaction()
+        try:
+            client = flask_app.test_client()
+            login_as_admin(client)
+            cookie_name = flask_app.config["SESSION_COOKIE_NAME"]
+            cookie = next((c for c in client.cookie_jar if c.name == cookie_name), None)
+        finally:
+            rollback()
+    assert cookie is not None, f"Login did not set {cookie_name} cookie"
+    return cookie.value
+
+
 @pytest.fixture(scope="function")
-def client(app):
+def client(app, admin_cookie):
     """Flask app tests client with already logged-in superuser"""
     client = app.test_client()
-    login_as_admin(client)
+    client.set_cookie(
+        app.config["SERVER_NAME"], app.config["SESSION_COOKIE_NAME"], admin_cookie
+    )
     return client
 
 
-@pytest.fixture(scope="function")
-def diff_project(app):
+@pytest.fixture(scope="session")
+def diff_project_cache(flask_app, request):
     """Modify testing project to contain some history with diffs. Geodiff lib is used to handle changes.
     Files are copied to location where server would expect it. Corresponding changes metadata and project versions
     are created and stored in db.
+    This is done only once per session, resulting files and db rows are snapshotted for diff_project fixture.
 
     Following changes are applied to base.gpkg in tests project (v1):
     v2: removed file -> previous version is lost (unless requested explicitly)
@@ -113,132 +272,218 @@ def diff_project(app):
     """
     from .test_project_controller import create_diff_meta
 
-    test_gpkg_file = os.path.join(test_project_dir, "test.gpkg")
-    try:
-        geodiff = GeoDiff()
-        project = Project.query.filter_by(
-            name=test_project, workspace_id=test_workspace_id
-        ).first()
-
-        update_meta = file_info(test_project_dir, "base.gpkg")
-        diff_meta_A = create_diff_meta(
-            "base.gpkg", "inserted_1_A.gpkg", test_project_dir
-        )
-        diff_meta_mod = create_diff_meta(
-            "base.gpkg", "modified_1_geom.gpkg", test_project_dir
-        )
-
-        patch = os.path.join(TMP_DIR, "patch")
-
-        basefile = os.path.join(test_project_dir, "base.gpkg")
-        copy(basefile, patch)
-        copy(basefile, test_gpkg_file)
-        geodiff.apply_changeset(
-            patch, os.path.join(TMP_DIR, diff_meta_mod["diff"]["path"])
-        )
-        diff_meta_B = create_diff_meta(
-            "base.gpkg", "inserted_1_B.gpkg", test_project_dir
-        )
-
-        changes = [
-            {
-                "added": [],
-                "removed": [file_info(test_project_dir, "base.gpkg")],
-                "updated": [],
-            },
-            {
-                "added": [file_info(test_project_dir, "base.gpkg")],
-                "removed": [],
-                "updated": [],
-            },
-            {"added": [], "removed": [], "updated": [diff_meta_A]},
-            {
-                "added": [],
-                "removed": [],
-                "updated": [update_meta],
-            },  # force update with full file
-            {"added": [], "removed": [], "updated": [diff_meta_mod]},
-            {"added": [], "removed": [], "updated": [diff_meta_B]},
-            {
-                "added": [],
-                "removed": [],
-                "updated": [],
-            },  # final state of base.gpkg (v8)
-            {
-                "added": [file_info(test_project_dir, "test.gpkg")],
-                "removed": [file_info(test_project_dir, "base.gpkg")],
-                "updated": [],
-            },  # file renamed, by removing old and upload new - break of history
-            {"added": [], "removed": [], "updated": []},
-        ]
-        version_files = project.files
-        for i, change in enumerate(changes):
-            ver = "v{}".format(i + 2)
-            if change["added"]:
-                meta = deepcopy(
-                    change["added"][0]
-                )  # during push we do not store 'location' in 'added' metadata
-                meta["location"] = os.path.join(ver, meta["path"])
-                new_file = os.path.join(project.storage.project_dir, meta["location"])
-                os.makedirs(os.path.dirname(new_file), exist_ok=True)
-                copy(os.path.join(test_project_dir, meta["path"]), new_file)
-                version_files.append(meta)
-            elif change["updated"]:
-                meta = change["updated"][0]
-                f_updated = next(f for f in version_files if f["path"] == meta["path"])
-                new_location = os.path.join(ver, f_updated["path"])
-                patchedfile = os.path.join(project.storage.project_dir, new_location)
-                os.makedirs(os.path.dirname(patchedfile), exist_ok=True)
-                if "diff" in meta.keys():
-                    basefile = os.path.join(
-                        project.storage.project_dir, f_updated["location"]
+    cache_dir = tempfile.mkdtemp(prefix="diff_project_", dir=TMP_DIR)
+
+    def teardown():
+        rmtree(cache_dir)
+
+    # registered right away so cache dir is removed also if building history fails
+    request.addfinalizer(teardown)
+    with flask_app.app_context():
+        init_test_project_files()
+        # objects are assembled in memory, avoid implicit flushes and re-selects after commit
+        rollback = _begin_rollback_transaction(autoflush=False, expire_on_commit=False)
+        test_gpkg_file = os.path.join(test_project_dir, "test.gpkg")
+        try:
+            geodiff = GeoDiff()
+            project = Project.query.filter_by(
+                name=test_project, workspace_id=test_workspace_id
+            ).first()
+
+            # checksum base.gpkg only once, each change gets its own copy as metadata are modified later
+            base_info = file_info(test_project_dir, "base.gpkg")
+            diff_meta_A = create_diff_meta(
+                "base.gpkg", "inserted_1_A.gpkg", test_project_dir, geodiff=geodiff
+            )
+            diff_meta_mod = create_diff_meta(
+                "base.gpkg", "modified_1_geom.gpkg", test_project_dir, geodiff=geodiff
+            )
+
+            patch = os.path.join(TMP_DIR, "patch")
+
+            basefile = os.path.join(test_project_dir, "base.gpkg")
+            # patch is modified by geodiff, it can not be linked with base.gpkg
+            copy(basefile, patch)
+            _stage(basefile, test_gpkg_file)
+            geodiff.apply_changeset(
+                patch, os.path.join(TMP_DIR, diff_meta_mod["diff"]["path"])
+            )
+            diff_meta_B = create_diff_meta(
+                "base.gpkg", "inserted_1_B.gpkg", test_project_dir, geodiff=geodiff
+            )
+
+            changes = [
+                {
+                    "added": [],
+                    "removed": [dict(base_info)],
+                    "updated": [],
+                },
+                {
+                    "added": [dict(base_info)],
+                    "removed": [],
+                    "updated": [],
+                },
+                {"added": [], "removed": [], "updated": [diff_meta_A]},
+                {
+                    "added": [],
+                    "removed": [],
+                    "updated": [dict(base_info)],
+                },  # force update with full file
+                {"added": [], "removed": [], "updated": [diff_meta_mod]},
+                {"added": [], "removed": [], "updated": [diff_meta_B]},
+                {
+                    "added": [],
+                    "removed": [],
+                    "updated": [],
+                },  # final state of base.gpkg (v8)
+                {
+                    "added": [file_info(test_project_dir, "test.gpkg")],
+                    "removed": [dict(base_info)],
+                    "updated": [],
+                },  # file renamed, by removing old and upload new - break of history
+                {"added": [], "removed": [], "updated": []},
+            ]
+            # current project files indexed by path
+            by_path = {f["path"]: f for f in project.files}
+            running_size = sum(f["size"] for f in by_path.values())
+            pvs = []
+            made_dirs = set()
+
+            def make_parent_dir(path):
+                parent = os.path.dirname(path)
+                if parent not in made_dirs:
+                    os.makedirs(parent, exist_ok=True)
+                    made_dirs.add(parent)
+
+            # plain rename is enough unless changesets need to cross filesystems
+            same_fs = (
+                os.stat(TMP_DIR).st_dev == os.stat(project.storage.project_dir).st_dev
+            )
+            relocate = os.replace if same_fs else move
+
+            for i, change in enumerate(changes):
+                ver = "v{}".format(i + 2)
+                if change["added"]:
+                    # during push we do not store 'location' in 'added' metadata
+                    meta = dict(change["added"][0])
+                    if "diff" in meta:
+                        meta["diff"] = dict(meta["diff"])
+                    meta["location"] = os.path.join(ver, meta["path"])
+                    new_file = os.path.join(
+                        project.storage.project_dir, meta["location"]
                     )
-                    changefile = os.path.join(TMP_DIR, meta["diff"]["path"])
-                    copy(basefile, patchedfile)
-                    geodiff.apply_changeset(patchedfile, changefile)
-                    meta["diff"]["location"] = os.path.join(ver, meta["diff"]["path"])
-                    move(
-                        changefile,
-                        os.path.join(
-                            project.storage.project_dir, meta["diff"]["location"]
-                        ),
+                    make_parent_dir(new_file)
+                    _stage(os.path.join(test_project_dir, meta["path"]), new_file)
+                    by_path[meta["path"]] = meta
+                    running_size += meta["size"]
+                elif change["updated"]:
+                    meta = change["updated"][0]
+                    f_updated = by_path[meta["path"]]
+                    new_location = os.path.join(ver, f_updated["path"])
+                    patchedfile = os.path.join(
+                        project.storage.project_dir, new_location
                     )
+                    make_parent_dir(patchedfile)
+                    if "diff" in meta.keys():
+                        basefile = os.path.join(
+                            project.storage.project_dir, f_updated["location"]
+                        )
+                        changefile = os.path.join(TMP_DIR, meta["diff"]["path"])
+                        copy(basefile, patchedfile)
+                        geodiff.apply_changeset(patchedfile, changefile)
+                        meta["diff"]["location"] = os.path.join(
+                            ver, meta["diff"]["path"]
+                        )
+                        relocate(
+                            changefile,
+                            os.path.join(
+                                project.storage.project_dir, meta["diff"]["location"]
+                            ),
+                        )
+                    else:
+                        _stage(
+                            os.path.join(test_project_dir, f_updated["path"]),
+                            patchedfile,
+                        )
+                        f_updated.pop("diff", None)
+                    meta["location"] = new_location
+                    running_size += meta["size"] - f_updated["size"]
+                    f_updated.update(meta)
+                if change["removed"]:
+                    f_removed = by_path.pop(change["removed"][0]["path"])
+                    running_size -= f_removed["size"]
                 else:
-                    copy(os.path.join(test_project_dir, f_updated["path"]), patchedfile)
-                    f_updated.pop("diff", None)
-                meta["location"] = new_location
-                f_updated.update(meta)
-            if change["removed"]:
-                f_removed = next(
-                    f
-                    for f in version_files
-                    if f["path"] == change["removed"][0]["path"]
+                    pass
+
+                version_files = list(by_path.values())
+                # files metadata are further modified, pv needs its own copy
+                pv = ProjectVersion(
+                    project,
+                    ver,
+                    project.creator.username,
+                    change,
+                    deepcopy(version_files),
+                    "127.0.0.1",
                 )
-                version_files.remove(f_removed)
-            else:
-                pass
-
-            pv = ProjectVersion(
-                project,
-                ver,
-                project.creator.username,
-                change,
-                version_files,
-                "127.0.0.1",
-            )
-            db.session.add(pv)
+                pvs.append(pv)
+                current_version = pv.name
+                assert pv.project_size == running_size
+
+            # version_files is a new list, no need to flag project files as modified
+            project.files = version_files
+            project.disk_usage = running_size
+            project.tags = resolve_tags(version_files)
+            project.latest_version = current_version
+            db.session.add(project)
+            db.session.add_all(pvs)
             db.session.commit()
-            version_files = pv.files
-            current_version = pv.name
-            assert pv.project_size == sum(file["size"] for file in version_files)
-
-        project.files = version_files
-        project.disk_usage = sum(file["size"] for file in project.files)
-        project.tags = resolve_tags(version_files)
-        project.latest_version = current_version
-        db.session.add(project)
-        flag_modified(project, "files")
-        db.session.commit()
-    finally:
-        os.remove(test_gpkg_file)
+
+            # snapshot project files and db rows on top of what initialize() created
+            copytree(project.storage.project_dir, cache_dir, dirs_exist_ok=True)
+            dump = {
+                "project": {
+                    "files": project.files,
+                    "disk_usage": project.disk_usage,
+                    "tags": project.tags,
+                    "latest_version": project.latest_version,
+                },
+                "versions": [
+                    {
+                        c.key: getattr(pv, c.key)
+                        for c in ProjectVersion.__table__.columns
+                        if c.key not in ("id", "project_id", "created")
+                    }
+                    for pv in pvs
+                ],
+            }
+            rmtree(project.storage.project_dir)
+        finally:
+            os.remove(test_gpkg_file)
+            rollback()
+
+    return cache_dir, dump
+
+
+@pytest.fixture(scope="function")
+def diff_project(app, diff_project_cache):
+    """Testing project with some history with diffs, restored from diff_project_cache snapshot"""
+    cache_dir, dump = diff_project_cache
+    project = Project.query.filter_by(
+        name=test_project, workspace_id=test_workspace_id
+    ).first()
+    rmtree(project.storage.project_dir)
+    copytree(cache_dir, project.storage.project_dir)
+
+    versions = deepcopy(dump["versions"])
+    created = datetime.utcnow()
+    for pv in versions:
+        pv["project_id"] = project.id
+        # history lookups rely on versions to be ordered by timestamp
+        created += timedelta(milliseconds=1)
+        pv["created"] = created
+    db.session.bulk_insert_mappings(ProjectVersion, versions)
+    for key, value in deepcopy(dump["project"]).items():
+        setattr(project, key, value)
+    db.session.add(project)
+    db.session.commit()
     return project
@@ -959,9 +959,10 @@ def test_download_fail(app, client):
     assert resp.status_code == 404
 
 
-def create_diff_meta(base, modified, project_dir):
-    """Create diff metadata for updating files."""
-    geodiff = GeoDiff()
+def create_diff_meta(base, modified, project_dir, geodiff=None):
+    """Create diff metadata for updating files. Optionally reuse existing GeoDiff instance."""
+    if geodiff is None:
+        geodiff = GeoDiff()
     diff_id = str(uuid.uuid4())
     diff_name = base + "-diff-" + diff_id
     basefile = os.path.join(project_dir, base)
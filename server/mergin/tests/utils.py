@@ -2,11 +2,14 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-MerginMaps-Commercial
 
+import hashlib
 import json
+import mmap
 import shutil
 import sqlite3
 import uuid
 import math
+import sys
 from datetime import datetime
 from flask import url_for, current_app
 import os
@@ -128,12 +131,20 @@ class DateTimeEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
-def initialize():
+def init_test_project_files():
+    """Copy files of default tests project to its storage (mimic files were uploaded)"""
     # clean up (in case of previous failures)
     proj_dir = os.path.join(current_app.config["LOCAL_PROJECTS"], DEFAULT_USER[0])
     if os.path.exists(proj_dir):
         shutil.rmtree(proj_dir)
 
+    shutil.copytree(
+        os.path.join(test_project_dir),
+        os.path.join(proj_dir, test_project, "v1"),
+    )
+
+
+def initialize():
     # add default user/super admin
     user = add_user(DEFAULT_USER[0], DEFAULT_USER[1], is_admin=True)
     workspace = create_workspace()
@@ -180,11 +191,19 @@ def initialize():
     db.session.add(pv)
     db.session.commit()
 
-    # mimic files were uploaded
-    shutil.copytree(
-        os.path.join(test_project_dir),
-        os.path.join(proj_dir, test_project, "v1"),
-    )
+    init_test_project_files()
+
+
+def file_checksum(path):
+    """Calculate sha1 checksum of file in a single pass handed over to hashlib"""
+    with open(path, "rb") as f:
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(f, "sha1").hexdigest()
+        if not os.fstat(f.fileno()).st_size:
+            # empty file can not be memory-mapped
+            return hashlib.sha1().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.sha1(mm).hexdigest()
 
 
 def file_info(project_dir, path, chunk_size=1024):
@@ -193,7 +212,7 @@ def file_info(project_dir, path, chunk_size=1024):
     f_size = os.path.getsize(abs_path)
     return {
         "path": path,
-        "checksum": generate_checksum(abs_path),
+        "checksum": file_checksum(abs_path),
         "size": f_size,
         "mtime": datetime.fromtimestamp(os.path.getmtime(abs_path), tzlocal()),
         "chunks": [str(uuid.uuid4()) for i in range(math.ceil(f_size / chunk_size))],